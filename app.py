@@ -1,9 +1,22 @@
 import os
-import json
-import re
-from flask import Flask, request, jsonify, send_from_directory
+import atexit
+import hashlib
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from typing import List, Optional
+import httpx
+import msgspec
+import orjson
+from cachetools import TTLCache
+from flask import Flask, Response, request, jsonify, send_from_directory
+from flask.json.provider import JSONProvider
 from dotenv import load_dotenv
-from openai import OpenAI, APIError # Import the OpenAI library and specific errors
+from openai import OpenAI, APIConnectionError, APIStatusError, APITimeoutError # Import the OpenAI library and specific errors
+from llm_cache import LLMCache
+from theme_cache import EmbeddingBatcher, ThemeCache
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -13,12 +26,70 @@ load_dotenv()
 # このファイルと同じ階層に 'static' フォルダがあれば自動的にそこが使われます。
 app = Flask(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """jsonify() や request.get_json() の変換に標準のjsonより高速な orjson を使う"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = OrjsonProvider(app)
+
 # --- 定数/設定値 ---
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 SITE_URL = os.getenv("YOUR_SITE_URL", "http://localhost:5000")
 APP_NAME = os.getenv("YOUR_APP_NAME", "FlaskVueApp")
 DEFAULT_SYSTEM_PROMPT = "あなたは親切なアシスタントです。丁寧な言葉遣いで、140字以内で簡潔に回答してください。"
 DEFAULT_MODEL = "google/gemma-3-27b-it:free"
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "openai/text-embedding-3-small")
+THEME_CACHE_THRESHOLD = float(os.getenv("THEME_CACHE_THRESHOLD", "0.92"))
+THEME_CACHE_TTL = int(os.getenv("THEME_CACHE_TTL", "3600"))
+# 埋め込みの取得に失敗した後、テーマキャッシュを使わずに検証する秒数
+THEME_CACHE_BACKOFF = float(os.getenv("THEME_CACHE_BACKOFF", "60"))
+# 埋め込みAPIのタイムアウト(秒)。超えたらキャッシュを使わない通常の検証に切り替える（EmbeddingBatcher の待ち時間もここから決める）
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "5"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# AI呼び出しの応答待ちの上限(秒)。SDKの自動再試行は止めているので、待ち時間が何倍にも延びることはない
+# (再試行中も実行枠を握り続け、待っている他のリクエストが先に 429/503 になってしまうため)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+# ストリーミング時、断片がこの文字数分たまるか、前回の送信からこの秒数が経った後に次の断片が届いたらまとめて送る
+# (時間の判定は断片が届いたときだけ行うため、次の断片が来るまで送信は保留される)
+STREAM_BATCH_CHARS = int(os.getenv("STREAM_BATCH_CHARS", "16"))
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL", "0.02"))
+
+# --- 固定のエラーレスポンス ---
+# 内容が変わらないエラー本文は起動時にJSONへ変換しておき、リクエストのたびに jsonify しない
+def _error_body(message):
+    return orjson.dumps({"error": message})
+
+_ERR_NO_API_KEY = _error_body("OpenRouter API key is not configured on the server.")
+_ERR_JSON_MISSING = _error_body("Request JSON is missing")
+_ERR_TOPIC_EMPTY = _error_body("'topic' cannot be empty")
+_ERR_USER_POSITION = _error_body("'user_position' must be either 'pro' or 'con'")
+_ERR_SESSION_NOT_FOUND = _error_body("Debate session not found or expired. Please start a new debate.")
+_ERR_MESSAGES_EMPTY = _error_body("'messages' array cannot be empty")
+_ERR_TEXT_EMPTY = _error_body("Input text cannot be empty")
+_ERR_SEND_API_FIELDS = _error_body("Request must contain either 'messages' array or 'text' field")
+_ERR_AI_CONNECTION = _error_body("AIサービスとの通信中にエラーが発生しました。")
+_ERR_AI_TIMEOUT = _error_body("AIサービスからの応答がタイムアウトしました。しばらくしてから再度お試しください。")
+_ERR_AI_UNREACHABLE = _error_body("AIサービスに接続できませんでした。しばらくしてから再度お試しください。")
+_ERR_THEME_MISSING = _error_body("Request must contain 'theme'")
+_ERR_THEME_EMPTY = _error_body("'theme' cannot be empty")
+_ERR_AI_JSON_NOT_FOUND = _error_body("AIの応答から有効なJSON形式のデータを見つけられませんでした。")
+_ERR_AI_JSON_INVALID = _error_body("AIからの応答をJSONとして解釈できませんでした。")
+_ERR_THEME_VALIDATION = _error_body("テーマの妥当性チェック中にAIサービスでエラーが発生しました。")
+_ERR_FEEDBACK_UNEXPECTED = _error_body("フィードバックの生成中に予期せぬサーバーエラーが発生しました。")
+_ERR_SESSION_BUSY = _error_body("前の発言への応答を処理中です。しばらくしてから再度お試しください。")
+_ERR_SERVER_BUSY = _error_body("AIサービスが混み合っています。しばらくしてから再度お試しください。")
+
+def raw_json_response(body, status=200):
+    """JSONに変換済みの本文からレスポンスを作る"""
+    return Response(body, status=status, mimetype='application/json')
 
 # 開発モード時に静的ファイルのキャッシュを無効にする
 if app.debug:
@@ -34,55 +105,383 @@ if app.debug:
 # --- OpenAIクライアントの初期化 ---
 # アプリケーション起動時に一度だけクライアントを初期化する
 if OPENROUTER_API_KEY:
+    # 接続プールを持つhttpxクライアントを共有し、リクエストごとのTCP/TLSハンドシェイクを避ける
+    _http = httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=30.0),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        http2=True,
+    )
+    atexit.register(_http.close)
+
     client = OpenAI(
-        base_url="https://openrouter.ai/api/v1",
+        base_url=OPENROUTER_BASE_URL,
         api_key=OPENROUTER_API_KEY,
         default_headers={ # Recommended by OpenRouter
             "HTTP-Referer": SITE_URL,
             "X-Title": APP_NAME,
-        }
+        },
+        http_client=_http,
     )
+
+    def _prewarm_connection():
+        # 本文の大きい一覧を取得しないよう HEAD で接続だけを確立する
+        try:
+            _http.head(f"{OPENROUTER_BASE_URL}/models", timeout=5.0)
+        except httpx.HTTPError as e:
+            app.logger.warning(f"Failed to pre-warm OpenRouter connection: {e}")
+
+    # 起動直後の最初のリクエストがTCP/TLSの接続確立を待たずに済むよう、裏で接続をプールに用意しておく
+    threading.Thread(target=_prewarm_connection, name="openrouter-prewarm", daemon=True).start()
 else:
     client = None
     app.logger.warning("環境変数 OPENROUTER_API_KEY が設定されていません。API呼び出しは失敗します。")
+
+def _embed_themes(texts):
+    # 再試行するとバッチ処理のスレッドが長く止まるため、失敗したらすぐ諦める
+    response = client.with_options(timeout=EMBEDDING_TIMEOUT, max_retries=0).embeddings.create(
+        model=EMBEDDING_MODEL, input=texts
+    )
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+# 同時に届いたテーマの埋め込みはまとめて1回のAPI呼び出しで取得する
+# 実行中のバッチの終了を待ってから自分のバッチが呼ばれることもあるため、待ち時間はAPIタイムアウトの2回分とする
+embedding_batcher = EmbeddingBatcher(_embed_themes, window=0.01, timeout=EMBEDDING_TIMEOUT * 2)
+
+# 似た言い回しのテーマ（例:「原発は是か非か」と「原子力発電の是非」）の検証結果を使い回す
+theme_cache = ThemeCache(
+    embedding_batcher.embed,
+    threshold=THEME_CACHE_THRESHOLD,
+    ttl=THEME_CACHE_TTL,
+    backoff=THEME_CACHE_BACKOFF,
+)
+
+# 同じモデル・同じメッセージのリクエスト（リロード後の再送信など）はAIを呼ばずに応答を返す
+llm_cache = LLMCache(maxsize=1024, ttl=LLM_CACHE_TTL)
+
+# --- ディベートセッション ---
+# /start_debate で発行した session_id ごとにシステムプロンプトを保持する
+# モジュール変数1つを共有するのではなく、利用者ごとに分けて保存する
+_sessions = TTLCache(maxsize=10_000, ttl=SESSION_TTL)
+_sessions_lock = threading.Lock()
+
+def get_session_prompt(session_id):
+    """セッションのシステムプロンプトを取得する。利用中のセッションは有効期限を延長する"""
+    with _sessions_lock:
+        prompt = _sessions.get(session_id)
+        if prompt is not None:
+            _sessions[session_id] = prompt
+        return prompt
+
+# --- AI呼び出しの同時実行制御 ---
+# OpenRouterのレート制限(429)を避けるため、サーバー全体での同時呼び出し数を制限する
+# さらに同じセッションの呼び出しは1つずつ順番に処理し、後の発言が先に処理されないようにする
+_llm_semaphore = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+_session_locks = TTLCache(maxsize=10_000, ttl=SESSION_TTL)
+
+class FifoLock:
+    """待っている順に取得できるロック。threading.Lock は待機中のスレッドのどれが次に取得するかを保証しない"""
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._waiters = deque()
+        self._locked = False
+
+    def acquire(self, timeout):
+        with self._mutex:
+            if not self._locked and not self._waiters:
+                self._locked = True
+                return True
+            # 解放する側が先頭の待機者の waiter を解放し、ロックをそのまま引き渡す
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+        if waiter.acquire(timeout=timeout):
+            return True
+        with self._mutex:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                # タイムアウトと同時に引き渡されていた
+                return True
+            return False
+
+    def release(self):
+        with self._mutex:
+            if self._waiters:
+                self._waiters.popleft().release()
+            else:
+                self._locked = False
+
+class LLMBusyError(Exception):
+    """AI呼び出しの実行枠を LLM_TIMEOUT 秒以内に確保できなかったときの例外"""
+
+    def __init__(self, body, status_code):
+        super().__init__(status_code)
+        self.body = body
+        self.status_code = status_code
+
+def acquire_llm_slot(session_id=None):
+    """AI呼び出しの実行枠を確保する。返り値の ExitStack を閉じると解放される"""
+    slot = ExitStack()
+    if session_id:
+        with _sessions_lock:
+            lock = _session_locks.get(session_id)
+            if lock is None:
+                lock = FifoLock()
+            # 利用中のセッションのロックが期限切れで捨てられないよう、使うたびに登録し直す
+            _session_locks[session_id] = lock
+        # 閉じられないレスポンスがあっても後続のリクエストが永久に待たないよう、待ち時間に上限を設ける
+        if not lock.acquire(timeout=LLM_TIMEOUT):
+            raise LLMBusyError(_ERR_SESSION_BUSY, 429)
+        slot.callback(lock.release)
+    if not _llm_semaphore.acquire(timeout=LLM_TIMEOUT):
+        slot.close()
+        raise LLMBusyError(_ERR_SERVER_BUSY, 503)
+    slot.callback(_llm_semaphore.release)
+    return slot
+
+def extract_json(text):
+    """AIの応答から最初のJSONオブジェクト/配列の部分を取り出す。見つからなければNoneを返す"""
+    starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+    if not starts:
+        return None
+    start = min(starts)
+
+    # 括弧の深さを数えながら1回だけ走査する（正規表現のバックトラックを避ける）
+    # 文字列リテラル内の括弧は数えない
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '{[':
+            depth += 1
+        elif ch in '}]':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+# --- ストリーミング応答 ---
+# リクエストに "stream": true が指定された場合、AIの応答をServer-Sent Eventsで逐次返す
+def sse_event(payload):
+    # orjson の出力はUTF-8のバイト列なので、文字列に戻さずそのまま送る
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+# 内容が固定のイベントは起動時に作っておき、送信のたびに変換しない
+_SSE_STREAM_ERROR = sse_event({"error": "AIサービスとの通信中にエラーが発生しました。"})
+_SSE_EMPTY_REPLY = sse_event({"t": "AIから有効な応答がありませんでした。"})
+_SSE_EMPTY_FEEDBACK = sse_event({"t": "AIからのフィードバックがありませんでした。会話が短すぎるか、内容を解釈できなかった可能性があります。"})
+
+def sse_response(events):
+    # direct_passthrough=True にすると call_on_close の後処理（実行枠の解放など）が呼ばれなくなるため使わない
+    # バイト列のイベントはWerkzeug側で再エンコードされずにそのまま送られる
+    return Response(events, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+def stream_chat_response(messages, cache_key, empty_event, session_id=None):
+    """ストリーミングでAIを呼び出し、その応答を返すResponseを作る"""
+    # 実行枠はレスポンスの送信が終わるまで保持する
+    slot = acquire_llm_slot(session_id)
+    try:
+        completion_stream = client.with_options(max_retries=0).chat.completions.create(
+            messages=messages,
+            model=DEFAULT_MODEL,
+            stream=True,
+            # 使用量の集計チャンクは使わないので要求しない
+            stream_options={"include_usage": False},
+            timeout=LLM_TIMEOUT,
+        )
+    except Exception:
+        slot.close()
+        raise
+    response = sse_response(stream_completion(completion_stream, cache_key, empty_event))
+    # ブラウザが途中で切断した場合もレスポンスは閉じられるので、そこでOpenRouterとの接続も閉じて生成を打ち切る
+    response.call_on_close(completion_stream.close)
+    response.call_on_close(slot.close)
+    return response
+
+def stream_completion(completion_stream, cache_key, empty_event):
+    """AIから届いた応答の断片を、届いた順にイベントとして送る。応答全体はキャッシュに保存する"""
+    chunks = []
+    # トークンごとに1イベントだと送信回数が多すぎるため、ある程度まとめてから送る
+    # 最初の断片はすぐに送り、表示開始までの時間は延ばさない
+    # 保留中の断片は次の断片の到着時か、応答の終わりにまとめて送る
+    pending_from = 0
+    pending_chars = 0
+    last_flush = 0.0
+    try:
+        for chunk in completion_stream:
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                chunks.append(delta)
+                pending_chars += len(delta)
+                now = time.monotonic()
+                if pending_chars >= STREAM_BATCH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                    yield sse_event({"t": "".join(chunks[pending_from:])})
+                    pending_from = len(chunks)
+                    pending_chars = 0
+                    last_flush = now
+    except Exception as e:
+        # ヘッダー送信後なのでステータスコードは変えられない。エラーはイベントとして通知する
+        app.logger.error(f"OpenRouter streaming failed: {e}")
+        if pending_chars:
+            yield sse_event({"t": "".join(chunks[pending_from:])})
+        yield _SSE_STREAM_ERROR
+        return
+
+    if pending_chars:
+        yield sse_event({"t": "".join(chunks[pending_from:])})
+
+    full_text = "".join(chunks).strip()
+    if full_text:
+        llm_cache.set(cache_key, full_text)
+    else:
+        app.logger.warning("AI returned an empty streamed response.")
+        yield empty_event
+
+# index.html は起動時に一度だけ読み込み、リクエストごとのファイルアクセスを避ける
+with open(os.path.join(app.static_folder, 'index.html'), 'rb') as f:
+    _INDEX_HTML = f.read()
+_INDEX_ETAG = hashlib.md5(_INDEX_HTML).hexdigest()
+_INDEX_HEADERS = {'ETag': f'"{_INDEX_ETAG}"', 'Cache-Control': 'public, max-age=60'}
+
 # URL:/ に対して、static/index.htmlを表示して
     # クライアントサイドのVue.jsアプリケーションをホストする
 @app.route('/')
 def index():
-    return send_from_directory(app.static_folder, 'index.html')
+    # 開発モードでは編集内容がすぐ反映されるよう、毎回ファイルから返す
+    if app.debug:
+        return send_from_directory(app.static_folder, 'index.html')
+    # ブラウザのキャッシュが最新なら本文を返さない
+    if _INDEX_ETAG in request.if_none_match:
+        return Response(status=304, headers=_INDEX_HEADERS)
+    return Response(_INDEX_HTML, mimetype='text/html', headers=_INDEX_HEADERS)
     
+# ディベート用システムプロンプトのひな形（テーマ, AIの立場）
+_DEBATE_PROMPT_TEMPLATE = """あなたは、ディベートAIです。ユーザーとディベートを行います。あなたの役割は、ユーザーの主張に対する直接的な反論を返すことです。いかなる場合でも、挨拶、相槌、前置き（「しかし、」「一方で、」など）、そしてあなた自身の立場を示す言葉（例:【否定派】）を一切含めず、文章の最初から反論の核心部分だけを記述してください。反論は250文字程度にまとめてください。
+
+---
+
+今回のディベートのテーマは「%s」です。
+あなたの立場は「%s」です。
+もしユーザーが後攻を選び、あなたが最初の発言者になった場合は、テーマに対してあなたの立場から最初の意見を述べてください。"""
+
+# ユーザーの立場ごとに、AIの反対の立場を埋め込んだテンプレートを起動時に作っておく（テーマの %s は残す）
+_DEBATE_PROMPTS = {
+    'pro': _DEBATE_PROMPT_TEMPLATE % ('%s', '否定派'),
+    'con': _DEBATE_PROMPT_TEMPLATE % ('%s', '肯定派'),
+}
+
+# /start_debate のリクエスト形式
+class StartDebateRequest(msgspec.Struct):
+    topic: str
+    user_position: str
+
+_start_debate_decoder = msgspec.json.Decoder(StartDebateRequest)
+
+# URL:/start_debate に対するメソッドを定義
+@app.route('/start_debate', methods=['POST'])
+def start_debate():
+    """ディベート用のシステムプロンプトを生成し、セッションIDを発行するエンドポイント"""
+    # 'topic' と 'user_position' の有無と型をデコード時に検証する
+    try:
+        data = _start_debate_decoder.decode(request.get_data())
+    except msgspec.ValidationError as e:
+        return jsonify({"error": f"Invalid request: {e}"}), 400
+    except msgspec.DecodeError:
+        return raw_json_response(_ERR_JSON_MISSING, 400)
+
+    topic = data.topic.strip()
+    if not topic:
+        return raw_json_response(_ERR_TOPIC_EMPTY, 400)
+
+    user_position = data.user_position
+    if user_position not in _DEBATE_PROMPTS:
+        return raw_json_response(_ERR_USER_POSITION, 400)
+
+    # テンプレートにはAIの立場が埋め込み済みなので、テーマを差し込むだけでよい
+    system_prompt = _DEBATE_PROMPTS[user_position] % topic
+
+    session_id = secrets.token_urlsafe(16)
+    with _sessions_lock:
+        _sessions[session_id] = system_prompt
+
+    app.logger.info(f"Started debate session {session_id} on theme: {topic}")
+    return jsonify({"session_id": session_id})
+
+# /send_api のリクエスト形式。デコードと同時に型を検証する
+class ChatMessage(msgspec.Struct):
+    role: str
+    content: str
+
+class SendApiRequest(msgspec.Struct):
+    messages: Optional[List[ChatMessage]] = None
+    text: Optional[str] = None
+    context: str = ""
+    session_id: Optional[str] = None
+    stream: bool = False
+
+_send_api_decoder = msgspec.json.Decoder(SendApiRequest)
+
+# /end_debate のリクエスト形式
+class EndDebateRequest(msgspec.Struct):
+    messages: List[ChatMessage]
+    session_id: Optional[str] = None
+    stream: bool = False
+
+_end_debate_decoder = msgspec.json.Decoder(EndDebateRequest)
+
 # URL:/send_api に対するメソッドを定義
 @app.route('/send_api', methods=['POST'])
 def send_api():
     if not client:
         app.logger.error("OpenRouter API key not configured.")
-        return jsonify({"error": "OpenRouter API key is not configured on the server."}), 500
+        return raw_json_response(_ERR_NO_API_KEY, 500)
     
-    # POSTリクエストからJSONデータを取得
-    data = request.get_json()
-    if not data:
-        return jsonify({"error": "Request JSON is missing"}), 400
+    # POSTリクエストのJSONを、各メッセージの 'role' と 'content' の検証も含めて一度にデコードする
+    try:
+        data = _send_api_decoder.decode(request.get_data())
+    except msgspec.ValidationError as e:
+        return jsonify({"error": f"Invalid request: {e}"}), 400
+    except msgspec.DecodeError:
+        return raw_json_response(_ERR_JSON_MISSING, 400)
 
     messages = []
 
+    # 'session_id' がある場合は、/start_debate で保存したシステムプロンプトを使う
+    session_id = data.session_id
+    session_prompt = None
+    if session_id:
+        session_prompt = get_session_prompt(session_id)
+        if session_prompt is None:
+            return raw_json_response(_ERR_SESSION_NOT_FOUND, 404)
+
     # 新形式: 'messages' 配列を受け取り、会話履歴全体を処理する
-    if 'messages' in data and isinstance(data['messages'], list):
-        messages = data['messages']
-        if not messages:
-            return jsonify({"error": "'messages' array cannot be empty"}), 400
-        # 簡単なバリデーション
-        for msg in messages:
-            if not all(k in msg for k in ('role', 'content')):
-                 return jsonify({"error": "Each message must have 'role' and 'content'"}), 400
+    if data.messages is not None:
+        messages = msgspec.to_builtins(data.messages)
+        # セッションがあれば、AI先攻の最初のターンのように履歴が空でもよい
+        if not messages and session_prompt is None:
+            return raw_json_response(_ERR_MESSAGES_EMPTY, 400)
+        if session_prompt is not None:
+            messages = [{"role": "system", "content": session_prompt}] + messages
         app.logger.info(f"Received message history with {len(messages)} entries.")
 
     # 旧形式: 'text' と 'context' を受け取る（後方互換性のため）
-    elif 'text' in data:
-        received_text = data.get('text', '').strip()
+    elif data.text is not None:
+        received_text = data.text.strip()
         if not received_text:
-            return jsonify({"error": "Input text cannot be empty"}), 400
+            return raw_json_response(_ERR_TEXT_EMPTY, 400)
 
-        system_prompt = data.get('context', '').strip() or DEFAULT_SYSTEM_PROMPT
+        system_prompt = data.context.strip() or DEFAULT_SYSTEM_PROMPT
         
         messages = [
             {"role": "system", "content": system_prompt},
@@ -91,31 +490,56 @@ def send_api():
         app.logger.info("Received single text input, creating new conversation.")
     
     else:
-        return jsonify({"error": "Request must contain either 'messages' array or 'text' field"}), 400
+        return raw_json_response(_ERR_SEND_API_FIELDS, 400)
+
+    stream = data.stream
+
+    cache_key = llm_cache.cache_key(DEFAULT_MODEL, messages)
+    if (cached_text := llm_cache.get(cache_key)) is not None:
+        app.logger.info(f"LLM cache hit ({llm_cache.stats()})")
+        if stream:
+            return sse_response([sse_event({"t": cached_text})])
+        return jsonify({"message": "AIによってデータが処理されました。", "processed_text": cached_text})
 
     try:
+        if stream:
+            return stream_chat_response(messages, cache_key, _SSE_EMPTY_REPLY, session_id)
+
         # OpenRouter APIを呼び出し
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model=DEFAULT_MODEL,
-        )
+        with acquire_llm_slot(session_id):
+            chat_completion = client.with_options(max_retries=0).chat.completions.create(
+                messages=messages,
+                model=DEFAULT_MODEL,
+                timeout=LLM_TIMEOUT,
+            )
         
         # APIからのレスポンスを取得
         # .strip() を使って、応答の前後の不要な空白や改行を削除する
         if chat_completion.choices and chat_completion.choices[0].message and chat_completion.choices[0].message.content:
             processed_text = chat_completion.choices[0].message.content.strip()
+            llm_cache.set(cache_key, processed_text)
         else:
             processed_text = "AIから有効な応答がありませんでした。" # No valid response from AI.
             
         return jsonify({"message": "AIによってデータが処理されました。", "processed_text": processed_text})
 
-    except APIError as e:
+    except LLMBusyError as e:
+        app.logger.warning(f"No LLM slot available (status {e.status_code}).")
+        return raw_json_response(e.body, e.status_code)
+    # タイムアウトと接続エラーには status_code がないため、ステータスを持つエラーより先に処理する
+    except APITimeoutError as e:
+        app.logger.error(f"OpenRouter API timed out: {e}")
+        return raw_json_response(_ERR_AI_TIMEOUT, 504)
+    except APIConnectionError as e:
+        app.logger.error(f"OpenRouter API connection failed: {e}")
+        return raw_json_response(_ERR_AI_UNREACHABLE, 502)
+    except APIStatusError as e:
         app.logger.error(f"OpenRouter API Error: {e}")
         return jsonify({"error": f"AIサービスでエラーが発生しました。ステータスコード: {e.status_code}"}), e.status_code or 500
     except Exception as e:
         app.logger.error(f"OpenRouter API call failed: {e}")
         # クライアントには具体的なエラー詳細を返しすぎないように注意
-        return jsonify({"error": f"AIサービスとの通信中にエラーが発生しました。"}), 500
+        return raw_json_response(_ERR_AI_CONNECTION, 500)
 
 # URL:/validate_theme に対するメソッドを定義
 @app.route('/validate_theme', methods=['POST'])
@@ -123,15 +547,26 @@ def validate_theme():
     """ディベートのテーマが適切かAIに判断させるエンドポイント"""
     if not client:
         app.logger.error("OpenRouter API key not configured.")
-        return jsonify({"error": "OpenRouter API key is not configured on the server."}), 500
+        return raw_json_response(_ERR_NO_API_KEY, 500)
 
     data = request.get_json()
     if not data or 'theme' not in data:
-        return jsonify({"error": "Request must contain 'theme'"}), 400
+        return raw_json_response(_ERR_THEME_MISSING, 400)
 
     theme = data['theme'].strip()
     if not theme:
-        return jsonify({"error": "'theme' cannot be empty"}), 400
+        return raw_json_response(_ERR_THEME_EMPTY, 400)
+
+    # 類似テーマの検証結果がキャッシュにあれば、AIを呼ばずにそのまま返す
+    # 埋め込みの取得に失敗してもテーマ検証自体は続行する（失敗後しばらくはキャッシュを使わない）
+    theme_vector = None
+    try:
+        theme_vector = theme_cache.embed(theme)
+        if theme_vector is not None and (cached_result := theme_cache.lookup(theme_vector)):
+            app.logger.info(f"Theme cache hit for: {theme} ({theme_cache.stats()})")
+            return jsonify(cached_result)
+    except Exception as e:
+        app.logger.warning(f"Theme cache lookup failed: {e}")
 
     # AIにテーマの妥当性を判断させるためのシステムプロンプト
     validation_system_prompt = """あなたはディベートテーマを考えるのを手伝うアシスタントです。ユーザーから提案されたテーマが、2者間でのディベートに適しているか、以下の観点からアドバイスをしてください。
@@ -154,46 +589,63 @@ def validate_theme():
 
     try:
         app.logger.info(f"Validating debate theme: {theme}")
-        chat_completion = client.chat.completions.create(
-            model=DEFAULT_MODEL,
-            messages=messages,
-        )
+        with acquire_llm_slot():
+            chat_completion = client.with_options(max_retries=0).chat.completions.create(
+                model=DEFAULT_MODEL,
+                messages=messages,
+                timeout=LLM_TIMEOUT,
+            )
 
         ai_response = chat_completion.choices[0].message.content
         app.logger.info(f"AI validation response: {ai_response}")
 
         # AIの応答からJSONオブジェクト/配列を抽出する
         # AIが説明文などを付けてもJSON部分だけを取り出せるようにする
-        json_match = re.search(r'\{.*\}|\[.*\]', ai_response, re.DOTALL)
-        if not json_match:
+        json_text = extract_json(ai_response)
+        if json_text is None:
             app.logger.error(f"No JSON object found in AI response: {ai_response}")
-            return jsonify({"error": "AIの応答から有効なJSON形式のデータを見つけられませんでした。"}), 500
+            return raw_json_response(_ERR_AI_JSON_NOT_FOUND, 500)
 
         try:
             # JSON文字列をPythonの辞書にパース
-            json_response = json.loads(json_match.group())
+            json_response = orjson.loads(json_text)
+            if theme_vector is not None and isinstance(json_response, dict) and 'judgement' in json_response:
+                theme_cache.store(theme_vector, {
+                    "judgement": json_response['judgement'],
+                    "reason": json_response.get('reason', ""),
+                })
             return jsonify(json_response)
-        except json.JSONDecodeError:
-            app.logger.error(f"Failed to parse extracted JSON string: {json_match.group()}")
-            return jsonify({"error": "AIからの応答をJSONとして解釈できませんでした。"}), 500
+        except orjson.JSONDecodeError:
+            app.logger.error(f"Failed to parse extracted JSON string: {json_text}")
+            return raw_json_response(_ERR_AI_JSON_INVALID, 500)
 
+    except LLMBusyError as e:
+        app.logger.warning(f"No LLM slot available for theme validation (status {e.status_code}).")
+        return raw_json_response(e.body, e.status_code)
     except Exception as e:
         app.logger.error(f"Error during theme validation: {e}")
-        return jsonify({"error": "テーマの妥当性チェック中にAIサービスでエラーが発生しました。"}), 500
+        return raw_json_response(_ERR_THEME_VALIDATION, 500)
 
 @app.route('/end_debate', methods=['POST'])
 def end_debate():
     """ディベート全体の内容についてAIにフィードバックを生成させるエンドポイント"""
     if not client:
         app.logger.error("OpenRouter API key not configured.")
-        return jsonify({"error": "OpenRouter API key is not configured on the server."}), 500
-
-    data = request.get_json()
-    if not data or 'messages' not in data:
-        return jsonify({"error": "Request must contain 'messages'"}), 400
+        return raw_json_response(_ERR_NO_API_KEY, 500)
 
-    conversation_history = data['messages']
-    user_message_count = sum(1 for msg in conversation_history if msg.get('role') == 'user')
+    try:
+        data = _end_debate_decoder.decode(request.get_data())
+    except msgspec.ValidationError as e:
+        return jsonify({"error": f"Invalid request: {e}"}), 400
+    except msgspec.DecodeError:
+        return raw_json_response(_ERR_JSON_MISSING, 400)
+
+    conversation_history = msgspec.to_builtins(data.messages)
+    stream = data.stream
+    session_id = data.session_id
+    # デコード時に全メッセージの 'role' が検証済みなので、そのまま数えられる
+    roles = [msg.role for msg in data.messages]
+    user_message_count = roles.count('user')
 
     # 会話の長さに応じてプロンプトを切り替える
     if user_message_count < 3:
@@ -219,27 +671,38 @@ def end_debate():
 """
 
     # 既存の会話履歴の先頭に、フィードバック用のシステムプロンプトを追加
-    messages_for_feedback = [{"role": "system", "content": feedback_system_prompt}] + conversation_history
+    messages_for_feedback = [{"role": "system", "content": feedback_system_prompt}, *conversation_history]
 
     # ユーザーの最後の発言が指示だと誤解されるのを防ぎつつ、その発言も評価対象に含めるため、
     # 会話履歴の最後に「ここまでがディベートです」という区切りを追加する。
     # これにより、AIは会話履歴の全体を評価対象として明確に認識できる。
     # history_for_feedback = conversation_history + [{"role": "system", "content": "--- ここまでがディベートの会話です ---"}]
 
-    messages_for_feedback = [{"role": "system", "content": feedback_system_prompt}]
+    cache_key = llm_cache.cache_key(DEFAULT_MODEL, messages_for_feedback)
+    if (cached_feedback := llm_cache.get(cache_key)) is not None:
+        app.logger.info(f"LLM cache hit for debate feedback ({llm_cache.stats()})")
+        if stream:
+            return sse_response([sse_event({"t": cached_feedback})])
+        return jsonify({"feedback": cached_feedback})
 
     try:
         app.logger.info(f"Generating debate feedback for a conversation with {len(conversation_history)} messages.")
-        chat_completion = client.chat.completions.create(
-            model=DEFAULT_MODEL,
-            messages=messages_for_feedback,
-        )
+        if stream:
+            return stream_chat_response(messages_for_feedback, cache_key, _SSE_EMPTY_FEEDBACK, session_id)
+
+        with acquire_llm_slot(session_id):
+            chat_completion = client.with_options(max_retries=0).chat.completions.create(
+                model=DEFAULT_MODEL,
+                messages=messages_for_feedback,
+                timeout=LLM_TIMEOUT,
+            )
 
-        feedback_text = chat_completion.choices[0].message.content.strip()
         feedback_text = ""
         # APIからのレスポンスが期待通りかチェックし、内容を取得
         if chat_completion.choices and chat_completion.choices[0].message and chat_completion.choices[0].message.content:
             feedback_text = chat_completion.choices[0].message.content.strip()
+            if feedback_text:
+                llm_cache.set(cache_key, feedback_text)
 
         # AIからの応答が空だった場合に備えて、デフォルトのメッセージを設定
         if not feedback_text:
@@ -251,12 +714,21 @@ def end_debate():
 
         return jsonify({"feedback": feedback_text})
 
-    except APIError as e:
+    except LLMBusyError as e:
+        app.logger.warning(f"No LLM slot available for feedback (status {e.status_code}).")
+        return raw_json_response(e.body, e.status_code)
+    except APITimeoutError as e:
+        app.logger.error(f"OpenRouter API timed out during feedback generation: {e}")
+        return raw_json_response(_ERR_AI_TIMEOUT, 504)
+    except APIConnectionError as e:
+        app.logger.error(f"OpenRouter API connection failed during feedback generation: {e}")
+        return raw_json_response(_ERR_AI_UNREACHABLE, 502)
+    except APIStatusError as e:
         app.logger.error(f"OpenRouter API Error during feedback generation: {e}")
         return jsonify({"error": f"フィードバック生成中にAIサービスでエラーが発生しました。ステータスコード: {e.status_code}"}), e.status_code or 500
     except Exception as e:
         app.logger.error(f"Error during debate feedback generation: {e}")
-        return jsonify({"error": "フィードバックの生成中に予期せぬサーバーエラーが発生しました。"}), 500
+        return raw_json_response(_ERR_FEEDBACK_UNEXPECTED, 500)
 
 # スクリプトが直接実行された場合にのみ開発サーバーを起動
 if __name__ == '__main__':
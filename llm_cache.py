@@ -0,0 +1,38 @@
+import hashlib
+import threading
+
+import orjson
+from cachetools import TTLCache
+
+
+class LLMCache:
+    """モデルとメッセージが完全に一致するリクエストのAI応答を再利用するキャッシュ"""
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # TTLCacheはスレッドセーフではないため、ロックで保護する
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(model, messages):
+        payload = orjson.dumps({"model": model, "messages": messages}, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
@@ -0,0 +1,142 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class ThemeCache:
+    """テーマの埋め込みベクトルで類似テーマの検証結果を再利用するキャッシュ"""
+
+    def __init__(self, embed, threshold=0.92, ttl=3600, maxsize=1024, backoff=60):
+        # embed: テキストを受け取り埋め込みベクトル(数値のリスト)を返す関数
+        self._embed = embed
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # 埋め込みに失敗したら backoff 秒の間は埋め込みを呼ばない
+        self.backoff = backoff
+        self._retry_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 正規化済みベクトルを行として持つ行列と、各行に対応する (結果, 登録時刻)
+        self._matrix = None
+        self._entries = []
+
+    def embed(self, text):
+        """テキストを埋め込み、コサイン類似度を内積で計算できるよう正規化して返す。
+        直前に埋め込みに失敗していて待機中の場合は None を返す"""
+        if time.monotonic() < self._retry_at:
+            return None
+        try:
+            vector = np.asarray(self._embed(text), dtype=np.float32)
+        except Exception:
+            # 埋め込みが使えない状態(未対応のモデルやキーなど)で、毎回失敗する呼び出しを待たないようにする
+            self._retry_at = time.monotonic() + self.backoff
+            raise
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector):
+        """類似度が閾値を超える登録済みテーマがあれば、その結果を返す"""
+        with self._lock:
+            self._evict_expired()
+            if self._matrix is not None and self._matrix.shape[1] == vector.shape[0]:
+                scores = self._matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] > self.threshold:
+                    self.hits += 1
+                    return dict(self._entries[best][0])
+            self.misses += 1
+            return None
+
+    def store(self, vector, result):
+        """テーマのベクトルと検証結果を登録する"""
+        with self._lock:
+            self._evict_expired()
+            row = vector.reshape(1, -1)
+            if self._matrix is None or self._matrix.shape[1] != row.shape[1]:
+                # 埋め込みモデルが変わって次元が合わない場合は作り直す
+                self._matrix = row
+                self._entries = []
+            else:
+                self._matrix = np.vstack([self._matrix, row])
+            self._entries.append((dict(result), time.monotonic()))
+
+            # 上限を超えた分は古いものから捨てる
+            overflow = len(self._entries) - self.maxsize
+            if overflow > 0:
+                self._matrix = self._matrix[overflow:]
+                self._entries = self._entries[overflow:]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _evict_expired(self):
+        # エントリは登録順に並んでいるので、期限切れは先頭に集まる
+        deadline = time.monotonic() - self.ttl
+        expired = 0
+        for _, created_at in self._entries:
+            if created_at >= deadline:
+                break
+            expired += 1
+        if expired:
+            self._matrix = self._matrix[expired:] if expired < len(self._entries) else None
+            self._entries = self._entries[expired:]
+
+
+class EmbeddingBatcher:
+    """短い時間内に届いた埋め込みリクエストをまとめ、1回のAPI呼び出しで処理する"""
+
+    def __init__(self, embed_many, window=0.01, max_batch=32, timeout=10.0):
+        # embed_many: テキストのリストを受け取り、同じ順序で埋め込みベクトルのリストを返す関数
+        self._embed_many = embed_many
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, text):
+        """埋め込みを依頼し、結果を受け取る Future を返す"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text):
+        """他のリクエストとまとめて埋め込み、結果が出るまで待つ"""
+        return self.submit(text).result(timeout=self.timeout)
+
+    def _ensure_started(self):
+        # 最初に使われたときにバックグラウンドスレッドを起動する
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # 最初のリクエストから window 秒の間に届いたものを同じバッチに入れる
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                vectors = self._embed_many([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
@@ -0,0 +1,17 @@
+# gevent を使って本番向けに起動するためのエントリーポイント
+# ssl や socket が読み込まれる前にパッチを当てる必要があるため、他のimportより先に実行する
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+from gevent.pywsgi import WSGIServer
+
+from app import app
+
+if __name__ == '__main__':
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "5000"))
+    # OpenRouterへの通信待ちの間は他のリクエストを処理できるため、1プロセスで多数の同時接続をさばける
+    app.logger.info(f"Starting gevent WSGI server on {host}:{port}")
+    WSGIServer((host, port), app).serve_forever()